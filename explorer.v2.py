@@ -4,86 +4,135 @@ from textual.containers import Horizontal
 from textual.widgets import Header, Tree, RichLog, Input, Log
 from rich.syntax import Syntax
 from rich.segment import Segment, Segments
-from rich.console import Console, ConsoleOptions, RenderResult
+from rich.console import Console, ConsoleOptions, Group, RenderResult
 from rich.padding import Padding
 from rich.style import Style
 import chapel
 import sys
 import ast
+import copy
+from array import array
+import functools
+import operator
+import types
 import typing
 
 # Implementation of exec_with_return from: https://stackoverflow.com/a/76636602
-def exec_with_return(code: str, globals: dict, locals: dict) -> typing.Any | None:
+# The parsed and compiled form of each command is cached, so that re-running
+# a command doesn't re-parse it.
+# The AST is compiled directly, without going back through source code.
+@functools.lru_cache(maxsize=256)
+def compile_command(code: str) -> tuple[types.CodeType, types.CodeType | None]:
     a = ast.parse(code)
     last_expression = None
     if a.body:
         if isinstance(a_last := a.body[-1], ast.Expr):
-            last_expression = ast.unparse(a.body.pop())
+            last_expression = a.body.pop().value
         elif isinstance(a_last, ast.Assign):
-            last_expression = ast.unparse(a_last.targets[0])
+            last_expression = as_load(a_last.targets[0])
         elif isinstance(a_last, (ast.AnnAssign, ast.AugAssign)):
-            last_expression = ast.unparse(a_last.target)
-    exec(ast.unparse(a), globals, locals)
-    if last_expression:
-        return eval(last_expression, globals, locals)
+            last_expression = as_load(a_last.target)
+    exec_code = compile(a, "<repl>", "exec")
+    eval_code = None
+    if last_expression is not None:
+        eval_code = compile(ast.Expression(body=last_expression), "<repl>", "eval")
+    return (exec_code, eval_code)
+
+# Assignment targets are in a "store" context; to evaluate one afterwards, we
+# need a copy of it that loads instead.
+def as_load(target: ast.expr) -> ast.expr:
+    target = copy.deepcopy(target)
+    for node in ast.walk(target):
+        if hasattr(node, "ctx"):
+            node.ctx = ast.Load()
+    return target
+
+def exec_with_return(code: str, globals: dict, locals: dict) -> typing.Any | None:
+    exec_code, eval_code = compile_command(code)
+    exec(exec_code, globals, locals)
+    if eval_code is not None:
+        return eval(eval_code, globals, locals)
+
+UNDERLINE = Style(underline=True)
 
 class SyntaxWithUnderline(Syntax):
     def __init__(self, location, *args, **kwargs):
         super().__init__(*args, **kwargs)
         (self.start_line, self.start_column), (self.end_line, self.end_column) = location
 
-    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
-        syntax_segments = self._get_syntax(console, options)
-
-        # Pre-process the syntax segments to track the current line and column,
-        # and to underline the specified range.
-        new_segments = []
-        for (line, seg_line) in enumerate(Segment.split_lines(syntax_segments)):
+    def underline_segments(self, lines: typing.Iterable[list[Segment]]) -> typing.Iterator[Segment]:
+        # This loop runs for every segment of the code, so look up the
+        # attributes and globals it uses only once.
+        start_line, start_col = self.start_line, self.start_column
+        end_line, end_col = self.end_line, self.end_column
+        _Segment, _UNDERLINE = Segment, UNDERLINE
+        code_lines = self.code.split("\n")
+
+        # Go through the syntax segments to track the current line and column,
+        # and to underline the specified range. Segments are produced as
+        # they're processed, rather than collected into a list.
+        for (line, seg_line) in enumerate(lines):
             if line > 0:
-                new_segments.append(Segment("\n"))
+                yield _Segment("\n")
 
-            if line < self.start_line or line > self.end_line:
+            if line < start_line or line > end_line:
                 continue
 
             # What part of this line region is highlighted?
-            start_pos = 0 if line > self.start_line else self.start_column
-            end_pos = sum(len(s) for s in seg_line) if line < self.end_line else self.end_column
+            start_pos = 0 if line > start_line else start_col
+            # Lines before the last one are highlighted to the end of their
+            # text, but not into the padding that Syntax adds after it.
+            end_pos = len(code_lines[line]) if line < end_line else end_col
 
             col = 0
             for segment in seg_line:
-                next_col = col + len(segment.text)
+                text = segment.text
+                text_len = len(text)
+                next_col = col + text_len
 
                 # Skip if we're out of bounds.
-                if line == self.start_line and next_col <= self.start_column:
-                    new_segments.append(segment)
+                if next_col <= start_pos or col >= end_pos:
+                    yield segment
                     col = next_col
                     continue
-                if line == self.end_line and col >= self.end_column:
-                    new_segments.append(segment)
+
+                # If the whole segment is in bounds, it doesn't need splitting.
+                style = segment.style
+                new_style = style + _UNDERLINE if style else _UNDERLINE
+                if col >= start_pos and next_col <= end_pos:
+                    yield _Segment(text, new_style)
                     col = next_col
                     continue
 
                 # Adjust desired sub-range.
                 my_start_pos = max(start_pos - col, 0)
-                my_end_pos = min(end_pos - col, len(segment.text))
+                my_end_pos = min(end_pos - col, text_len)
 
-                # Pieces before and after are unchanged.
-                new_style = segment.style.copy() if segment.style else Style()
-                new_style += Style(underline=True)
-                new_segments.append(Segment(segment.text[0:my_start_pos], segment.style))
-                new_segments.append(Segment(segment.text[my_start_pos:my_end_pos], new_style))
-                new_segments.append(Segment(segment.text[my_end_pos:], segment.style))
+                # Pieces before and after are unchanged. The segment overlaps
+                # the range only partially, so at most one of them is empty.
+                if my_start_pos > 0:
+                    yield _Segment(text[0:my_start_pos], style)
+                yield _Segment(text[my_start_pos:my_end_pos], new_style)
+                if my_end_pos < text_len:
+                    yield _Segment(text[my_end_pos:], style)
 
                 col = next_col
 
-        # Code from parent, as before.
-        segments = Segments(new_segments)
+    def __rich_console__(self, console: Console, options: ConsoleOptions) -> RenderResult:
+        syntax_segments = self._get_syntax(console, options)
+        segments = self.underline_segments(Segment.split_lines(syntax_segments))
+
+        # Code from parent, as before. Padding needs a renderable to wrap,
+        # but otherwise the segments can be handed to rich directly.
         if self.padding:
             yield Padding(
-                segments, style=self._theme.get_background_style(), pad=self.padding
+                Segments(segments), style=self._theme.get_background_style(), pad=self.padding
             )
         else:
-            yield segments
+            yield from segments
+            # Newlines only separate lines, so end the last one here; otherwise
+            # whatever's rendered next (e.g. in a Group) joins that line.
+            yield Segment.line()
 
 class AstExplorer(App):
     def __init__(self):
@@ -98,9 +147,10 @@ class AstExplorer(App):
         # Interactive state.
         self.selected_ast = None
         self.history = []
+        self.history_names = []
         self.env = {}
         self.repl_globals = globals().copy()
-        self.tree_nodes_for_ast = {}
+        self.tree_nodes_for_ast = []
 
         # Configure some REPL commands.
         self.repl_globals['print'] = lambda *args: self.print(*args)
@@ -110,52 +160,180 @@ class AstExplorer(App):
     def load_file(self):
         self.asts = self.context.parse(self.file)
         self.text = self.context.get_file_text(self.file)
-        self.text_lines = self.text.splitlines()
-        self.max_line_length = max(len(line) for line in self.text_lines)
-
-    def populate_tree_with_asts(self, ast, add_to):
-        for child in ast:
-            self.populate_tree_with_ast(child, add_to)
+        # Offset of the start of each line in self.text, followed by the
+        # offset one past the end of the text (as if it ended in a newline).
+        self.line_offsets = array('i', [0])
+        newline = self.text.find("\n")
+        while newline != -1:
+            self.line_offsets.append(newline + 1)
+            newline = self.text.find("\n", newline + 1)
+        if self.line_offsets[-1] != len(self.text) + 1:
+            self.line_offsets.append(len(self.text) + 1)
+
+        # Each line's length is the distance to the next line's start, minus
+        # the newline.
+        self.max_line_length = max(map(operator.sub, self.line_offsets[1:], self.line_offsets)) - 1
+        self.index_asts()
+
+        # The text only changes when the file is reloaded, so the unselected
+        # view can be reused until then.
+        self.full_syntax = Syntax(self.text, "chapel", indent_guides=True)
+
+    def split_text(self, first_line, last_line):
+        last_line = min(last_line, len(self.line_offsets) - 1)
+        selected_start = self.line_offsets[first_line-1]
+        selected_end = self.line_offsets[last_line]
+        return (self.text[:max(selected_start - 1, 0)],
+                self.text[selected_start:selected_end - 1],
+                self.text[selected_end:].removesuffix("\n"))
+
+    def index_asts(self):
+        # Walk the AST once, assigning each node a sequential index, and
+        # store the information we need about it in flat arrays. This way,
+        # the rest of the explorer doesn't have to go back to the chapel
+        # bindings for tags, locations, or children.
+        self.nodes = []
+        self.node_index = {}
+        self.node_index_by_unique_id = {}
+        self.kind_names = []
+        kind_ids = {}
+        self.node_kind = array('H')
+        self.node_start_line = array('i')
+        self.node_start_col = array('i')
+        self.node_end_line = array('i')
+        self.node_end_col = array('i')
+        self.node_first_child = array('i')
+        self.node_next_sibling = array('i')
+        self.node_parent = array('i')
+        self.root_nodes = []
+        last_child = array('i')
+
+        # Walk with an explicit stack rather than recursion, so that deeply
+        # nested files don't run into the recursion limit. The stack holds
+        # each open node's child iterator, so that the children are only
+        # walked once, and in order.
+        stack = [(iter(self.asts), -1)]
+        while stack:
+            children, parent = stack[-1]
+            node = next(children, None)
+            if node is None:
+                stack.pop()
+                continue
 
-    def populate_tree_with_ast(self, ast, add_to):
-        label = ast.tag()
-        children = list(ast)
-        my_node = add_to.add(label, data=ast) if len(children) > 0 else add_to.add_leaf(label, data=ast)
-        self.tree_nodes_for_ast[ast.unique_id()] = my_node
+            i = len(self.nodes)
+            self.nodes.append(node)
+            self.node_index[id(node)] = i
+            self.node_index_by_unique_id[node.unique_id()] = i
+
+            tag = node.tag()
+            kind = kind_ids.get(tag)
+            if kind is None:
+                kind = kind_ids[tag] = len(self.kind_names)
+                self.kind_names.append(tag)
+            self.node_kind.append(kind)
+
+            loc = node.location()
+            (start_line, start_col), (end_line, end_col) = loc.start(), loc.end()
+            self.node_start_line.append(start_line)
+            self.node_start_col.append(start_col)
+            self.node_end_line.append(end_line)
+            self.node_end_col.append(end_col)
+
+            # Link the node into its parent's list of children.
+            self.node_first_child.append(-1)
+            self.node_next_sibling.append(-1)
+            self.node_parent.append(parent)
+            last_child.append(-1)
+            if parent == -1:
+                self.root_nodes.append(i)
+            else:
+                if last_child[parent] == -1:
+                    self.node_first_child[parent] = i
+                else:
+                    self.node_next_sibling[last_child[parent]] = i
+                last_child[parent] = i
+
+            stack.append((iter(node), i))
+
+    def index_of(self, ast):
+        # The tree and the REPL's current_node hand back the same objects
+        # that were indexed, so look those up by identity first. Other ways
+        # of reaching a node through the chapel API (e.g. parent()) may
+        # produce a different wrapper object for it, so fall back to
+        # unique_id(), which doesn't depend on the wrapper.
+        i = self.node_index.get(id(ast))
+        if i is not None and self.nodes[i] is ast:
+            return i
+        i = self.node_index_by_unique_id.get(ast.unique_id())
+        if i is None:
+            raise ValueError("node is not part of the currently loaded file")
+        return i
+
+    def node_children(self, i):
+        child = self.node_first_child[i]
+        while child != -1:
+            yield child
+            child = self.node_next_sibling[child]
+
+    def node_location(self, i):
+        # Same shape as (location.start(), location.end()), but read from the
+        # arrays filled in by index_asts rather than from the chapel bindings.
+        return ((self.node_start_line[i], self.node_start_col[i]),
+                (self.node_end_line[i], self.node_end_col[i]))
+
+    def populate_tree_with_asts(self, roots, add_to):
+        self.tree_nodes_for_ast = [None] * len(self.nodes)
+        for root in roots:
+            self.add_placeholder(root, add_to)
+
+    def add_placeholder(self, i, add_to):
+        # The node's children aren't added until it's expanded (see
+        # populate_children), but it's still marked as expandable.
+        label = self.kind_names[self.node_kind[i]]
+        has_children = self.node_first_child[i] != -1
+        my_node = add_to.add(label, data=self.nodes[i], expand=False, allow_expand=has_children)
+        self.tree_nodes_for_ast[i] = my_node
+        return my_node
+
+    def populate_children(self, i):
+        # Children are added all at once, so if the first one is already in
+        # the tree, there's nothing left to do.
+        first_child = self.node_first_child[i]
+        if first_child == -1 or self.tree_nodes_for_ast[first_child] is not None:
+            return
 
-        for child in children:
-            self.populate_tree_with_ast(child, my_node)
+        my_node = self.tree_nodes_for_ast[i]
+        for child in self.node_children(i):
+            self.add_placeholder(child, my_node)
 
     def show_ast(self, ast):
         self.selected_ast = ast
         if ast is None:
             self.codelog.clear()
-            self.codelog.write(Syntax(self.text, "chapel", indent_guides=True))
+            self.codelog.write(self.full_syntax)
             return
 
-        loc = ast.location()
-        first_line, first_col = loc.start()
-        last_line, last_col = loc.end()
+        (first_line, first_col), (last_line, last_col) = self.node_location(self.index_of(ast))
         if first_line == -1:
             return
 
         # Underline location, relative to first line and column.
         underline_loc = ((0, first_col - 1), (last_line - first_line, last_col - 1))
 
-        lines_before = self.text_lines[:first_line-1]
-        lines_selected = self.text_lines[first_line-1:last_line]
-        lines_after = self.text_lines[last_line:]
+        text_before, text_selected, text_after = self.split_text(first_line, last_line)
         self.codelog.clear()
-        self.codelog.write(Syntax("\n".join(lines_before), "text", indent_guides=True))
-        self.codelog.write(SyntaxWithUnderline(underline_loc, "\n".join(lines_selected), "chapel", indent_guides=True))
-        self.codelog.write(Syntax("\n".join(lines_after), "text", indent_guides=True))
+        self.codelog.write(Group(
+            Syntax(text_before, "text", indent_guides=True),
+            SyntaxWithUnderline(underline_loc, text_selected, "chapel", indent_guides=True),
+            Syntax(text_after, "text", indent_guides=True),
+        ))
 
         self.codelog.scroll_to(x = 0, y = max(0, first_line - 1. - 5))
 
     def compose(self) -> ComposeResult:
         yield Header()
         self.mytree = Tree("Chapel AST")
-        self.populate_tree_with_asts(self.asts, self.mytree.root)
+        self.populate_tree_with_asts(self.root_nodes, self.mytree.root)
 
         self.codelog = RichLog(highlight=True, markup=False, min_width=self.max_line_length + 1)
         self.codelog.auto_scroll = False
@@ -171,11 +349,15 @@ class AstExplorer(App):
     def on_tree_node_selected(self, node_selected):
         self.show_ast(node_selected.node.data)
 
+    def on_tree_node_expanded(self, node_expanded):
+        ast = node_expanded.node.data
+        if ast is None:
+            return
+        self.populate_children(self.index_of(ast))
+
     @on(Input.Submitted)
     def on_input_submitted(self, changed: Input.Submitted):
         self.env["current_node"] = self.selected_ast
-        for (i, val) in enumerate(self.history):
-            self.env[f"_{i}"] = val
 
         command = changed.value
         log = self.query_one(Log)
@@ -183,27 +365,56 @@ class AstExplorer(App):
         try:
             val = exec_with_return(command, self.repl_globals, self.env)
             if val is not None:
-                log.write_line(f"_{len(self.history)} = {str(val)}")
-                self.history.append(val)
+                name = self.add_to_history(val)
+                log.write_line(f"{name} = {str(val)}")
         except Exception as e:
             log.write_line(str(e))
         changed.input.clear()
 
+    def add_to_history(self, val):
+        # The environment is shared by all commands, so each history entry
+        # only needs to be bound once, here.
+        idx = len(self.history)
+        while len(self.history_names) <= idx:
+            self.history_names.append(f"_{len(self.history_names)}")
+        name = self.history_names[idx]
+        self.history.append(val)
+        self.env[name] = val
+        return name
+
     def print(self, *args):
         self.repllog.write_line(" ".join(map(str, args)))
 
     def select_node(self, ast):
         if self.tree is None:
             return None
-        tree_node = self.tree_nodes_for_ast[ast.unique_id()]
-        self.mytree.select_node(tree_node)
+        i = self.index_of(ast)
+
+        # The node might not be in the tree yet; add and expand its
+        # ancestors, starting from the outermost one (the tree's own root,
+        # which starts out collapsed).
+        ancestors = []
+        parent = self.node_parent[i]
+        while parent != -1:
+            ancestors.append(parent)
+            parent = self.node_parent[parent]
+        self.mytree.root.expand()
+        for ancestor in reversed(ancestors):
+            self.populate_children(ancestor)
+            self.tree_nodes_for_ast[ancestor].expand()
+
+        # Tree nodes that were just added don't have a line in the tree until
+        # it's rebuilt on the next refresh, and Tree.select_node needs one to
+        # move the cursor; so put off selecting until then.
+        tree_node = self.tree_nodes_for_ast[i]
+        self.mytree.call_after_refresh(self.mytree.select_node, tree_node)
         self.show_ast(ast)
 
     def reparse(self):
         self.context.advance_to_next_revision(False)
         self.load_file()
         self.mytree.root.remove_children()
-        self.populate_tree_with_asts(self.asts, self.mytree.root)
+        self.populate_tree_with_asts(self.root_nodes, self.mytree.root)
         self.show_ast(None)
 
 